@@ -124,6 +124,7 @@ class HPOConfig(object):
             parser.add_argument( '--gamma',           type = float, default = 0. )  # noqa
             parser.add_argument( '--alpha',           type = float, default = 0. )  # noqa
             parser.add_argument( '--seed',            type = int,   default = 0 )  # noqa
+            parser.add_argument( '--max_bin',         type = int,   default = 256 )  # noqa
 
             args, unknown_args = parser.parse_known_args(input_args)
 
@@ -136,6 +137,7 @@ class HPOConfig(object):
                 'random_state': args.seed,
                 'verbosity': 0,
                 'seed': args.seed,
+                'max_bin': args.max_bin,
                 'objective': 'binary:logistic'
             }
 
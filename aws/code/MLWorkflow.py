@@ -17,11 +17,15 @@
 from abc import abstractmethod
 
 import functools
+import os
 import time
 
 import logging
 hpo_log = logging.getLogger('hpo_log')
 
+# per-stage timing, disable with AWS_HPO_TIMING=0 [ decided at import time ]
+ENABLE_TIMING = os.environ.get('AWS_HPO_TIMING', '1') != '0'
+
 
 def create_workflow(hpo_config):
     """ Workflow Factory [instantiate MLWorkflow based on config] """
@@ -72,13 +76,21 @@ class MLWorkflow():
 
 
 def timer_decorator(target_function):
+    """ Log the execution time of a workflow stage [ if ENABLE_TIMING ] """
+    if not ENABLE_TIMING:
+        return target_function
 
     @functools.wraps(target_function)
     def timed_execution_wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
+        start_time = time.perf_counter_ns()
         result = target_function(*args, **kwargs)
-        exec_time = time.perf_counter() - start_time
-        hpo_log.info(f" --- {target_function.__name__}"
-                     f" completed in {exec_time:.5f} s")
+        _log_exec_time(target_function, start_time)
         return result
     return timed_execution_wrapper
+
+
+def _log_exec_time(target_function, start_time):
+    """ Log the time elapsed since start_time [ perf_counter_ns ] """
+    exec_time = (time.perf_counter_ns() - start_time) / 1e9
+    hpo_log.debug(f" --- {target_function.__name__}"
+                  f" completed in {exec_time:.5f} s")
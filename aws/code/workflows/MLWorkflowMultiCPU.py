@@ -211,20 +211,12 @@ class MLWorkflowMultiCPU(MLWorkflow):
                 joblib.dump(trained_model, f'{output_filename}_mcpu_rf')
 
     @timer_decorator
-    async def cleanup(self, i_fold):
-        """ 
-        Close and restart the cluster when multiple cross validation
-        folds are used to prevent memory creep.
-        """
+    def cleanup(self, i_fold):
+        """ Close the cluster once all cross validation folds are complete """
         if i_fold == self.hpo_config.cv_folds - 1:
             hpo_log.info('> done all folds; closing cluster\n')
-            await self.client.close()
-            await self.cluster.close()
-        elif i_fold < self.hpo_config.cv_folds - 1:
-            hpo_log.info('> end of fold; reinitializing cluster\n')
-            await self.client.close()
-            await self.cluster.close()
-            self.cluster, self.client = self.cluster_initialize()
+            self.client.close()
+            self.cluster.close()
 
     def emit_final_score(self):
         """ Emit score for parsing by the cloud HPO orchestrator """
@@ -17,20 +17,21 @@
 
 import time
 import os
+import gc
 
 import dask
+import cudf
 import dask_cudf
 from dask_cuda import LocalCUDACluster
-from dask.distributed import wait, Client
+from dask_cuda.utils import get_device_total_memory
+from dask.distributed import wait, Client, futures_of
 
 import cupy
+import pyarrow.parquet
 import xgboost
 import joblib
 
-from dask_ml.model_selection import train_test_split
-from cuml.dask.common.utils import persist_across_workers
 from cuml.dask.ensemble import RandomForestClassifier
-from cuml.metrics import accuracy_score
 
 from MLWorkflow import MLWorkflow, timer_decorator
 
@@ -40,6 +41,88 @@ import warnings
 hpo_log = logging.getLogger('hpo_log')
 warnings.filterwarnings("ignore")
 
+# fraction of each GPU's memory reserved up front for the RMM pool
+RMM_POOL_FRACTION = 0.8
+
+# RMM pool sizes must be a multiple of this many bytes
+RMM_POOL_ALIGNMENT = 256
+
+# upper bound on the bytes of CSV text parsed by a single read task
+CSV_MAX_CHUNKSIZE = 256 * 2**20
+
+# fraction of each GPU's memory budgeted for the decoded columns of a
+# single Parquet partition [ the read, dropna and cast each hold a copy ]
+PARQUET_PARTITION_MEMORY_FRACTION = 1 / 16
+
+# folds the dataset is divided into, at least 4 so that each test fold
+# holds at most 25% of the samples
+MIN_CV_SPLITS = 4
+
+
+def _drop_missing_and_cast(df, dtype):
+    """ Drop samples with missing data and cast to the dataset dtype """
+    return df.dropna().astype(dtype)
+
+
+def _parquet_row_groups_per_partition(filenames, columns, n_workers,
+                                      max_partition_bytes):
+    """
+    Row groups read into each Parquet partition, as many as fit within
+    max_partition_bytes [ uncompressed ] while leaving every worker at
+    least one partition
+    """
+    n_row_groups = 0
+    uncompressed_bytes = 0
+    for filename in filenames:
+        metadata = pyarrow.parquet.ParquetFile(filename).metadata
+        n_row_groups += metadata.num_row_groups
+        for i_row_group in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i_row_group)
+            uncompressed_bytes += sum(
+                row_group.column(i_column).total_uncompressed_size
+                for i_column in range(row_group.num_columns)
+                if row_group.column(i_column).path_in_schema in columns
+            )
+
+    row_group_bytes = max(1, uncompressed_bytes // max(1, n_row_groups))
+    return max(1, min(max_partition_bytes // row_group_bytes,
+                      n_row_groups // n_workers))
+
+
+def _assign_cv_folds(df, n_splits, seed):
+    """ Draw a random CV fold index for each sample in a partition """
+    fold_ids = cupy.random.RandomState(seed).randint(
+        0, n_splits, size=len(df), dtype=cupy.int32
+    )
+    return cudf.Series(fold_ids, index=df.index, name='cv_fold')
+
+
+def _fold_features(df, cv_fold_ids, i_fold, label_column, holdout):
+    """ Features of the held-out [ holdout ] or training samples """
+    fold_mask = cv_fold_ids == i_fold
+    return df[fold_mask if holdout else ~fold_mask].drop(
+        columns=[label_column]
+    )
+
+
+def _fold_labels(df, cv_fold_ids, i_fold, label_column, holdout):
+    """ Labels of the held-out [ holdout ] or training samples """
+    fold_mask = cv_fold_ids == i_fold
+    return df[fold_mask if holdout else ~fold_mask][label_column]
+
+
+def _concat_fold_subsets(fold_subset, partitions, cv_fold_ids, *args):
+    """ Concatenate a fold subset of several partitions [ on one worker ] """
+    return cudf.concat([
+        fold_subset(df, df_cv_fold_ids, *args)
+        for df, df_cv_fold_ids in zip(partitions, cv_fold_ids)
+    ])
+
+
+def _count_correct(y_true, y_pred):
+    """ Count matching labels in a partition [ on device ] """
+    return int((y_true.values == y_pred.values).sum())
+
 
 class MLWorkflowMultiGPU(MLWorkflow):
     """ Multi-GPU Workflow """
@@ -50,10 +133,24 @@ class MLWorkflowMultiGPU(MLWorkflow):
 
         self.hpo_config = hpo_config
         self.dataset_cache = None
+        self.dataset_futures = None
+        self.cv_fold_id_futures = None
+        self.partition_workers = None
+        self.fold_futures = None
 
         self.cv_fold_scores = []
         self.best_score = -1
 
+        # select the model specific code paths once, rather than per call
+        if 'XGBoost' in self.hpo_config.model_type:
+            self._fit = self._fit_xgboost
+            self._predict = self._predict_xgboost
+            self._save_model = self._save_xgboost
+        elif 'RandomForest' in self.hpo_config.model_type:
+            self._fit = self._fit_randomforest
+            self._predict = self._predict_randomforest
+            self._save_model = self._save_randomforest
+
         self.cluster, self.client = self.cluster_initialize()
 
     @timer_decorator
@@ -65,7 +162,16 @@ class MLWorkflowMultiGPU(MLWorkflow):
 
         self.n_workers = cupy.cuda.runtime.getDeviceCount()
 
-        cluster = LocalCUDACluster(n_workers=self.n_workers)
+        # pre-allocate an RMM memory pool on each worker so that cuDF and
+        # XGBoost allocations are served from the pool rather than the driver;
+        # rounded down, since dask-cuda passes the size to RMM unaligned
+        rmm_pool_size = (
+            int(get_device_total_memory() * RMM_POOL_FRACTION)
+            // RMM_POOL_ALIGNMENT * RMM_POOL_ALIGNMENT
+        )
+
+        cluster = LocalCUDACluster(n_workers=self.n_workers,
+                                   rmm_pool_size=rmm_pool_size)
         client = Client(cluster)
 
         hpo_log.info(f'dask multi-GPU cluster with {self.n_workers} workers ')
@@ -78,7 +184,10 @@ class MLWorkflowMultiGPU(MLWorkflow):
         return cluster, client
 
     def ingest_data(self):
-        """ Ingest dataset, CSV and Parquet supported [ async/lazy ]"""
+        """
+        Ingest dataset, CSV and Parquet supported
+        [ blocking, the dataset is persisted on the workers and cached ]
+        """
 
         if self.dataset_cache is not None:
             hpo_log.info('> skipping ingestion, using cache')
@@ -87,118 +196,260 @@ class MLWorkflowMultiGPU(MLWorkflow):
         if 'Parquet' in self.hpo_config.input_file_type:
             hpo_log.info('> parquet data ingestion')
 
+            # group row groups into partitions that fit a device memory
+            # budget, which bounds the peak memory of each read task while
+            # keeping partitions large [ fewer tasks and larger kernels ]
+            row_groups_per_partition = _parquet_row_groups_per_partition(
+                self.hpo_config.target_files,
+                self.hpo_config.dataset_columns,
+                self.n_workers,
+                int(get_device_total_memory()
+                    * PARQUET_PARTITION_MEMORY_FRACTION)
+            )
+            hpo_log.info(f'\t row groups per partition: '
+                         f'{row_groups_per_partition}')
+
             dataset = dask_cudf.read_parquet(
                 self.hpo_config.target_files,
-                columns=self.hpo_config.dataset_columns
+                columns=self.hpo_config.dataset_columns,
+                split_row_groups=row_groups_per_partition
             )
 
         elif 'CSV' in self.hpo_config.input_file_type:
             hpo_log.info('> csv data ingestion')
 
+            # split the input into byte ranges so that every worker parses
+            # and copies a share of the data to its GPU concurrently
+            total_bytes = sum(os.path.getsize(filename)
+                              for filename in self.hpo_config.target_files)
+            chunksize = min(CSV_MAX_CHUNKSIZE,
+                            max(1, -(-total_bytes // self.n_workers)))
+
             dataset = dask_cudf.read_csv(
                 self.hpo_config.target_files,
                 names=self.hpo_config.dataset_columns,
-                header=0
+                header=0,
+                chunksize=chunksize
+            )
+
+        # at least one partition per worker, so that every GPU holds data
+        if dataset.npartitions < self.n_workers:
+            dataset = dataset.repartition(npartitions=self.n_workers)
+
+        # drop missing samples and cast in a single pass over each partition,
+        # so the cached data is already clean and in its final dtype
+        dataset = dataset.map_partitions(_drop_missing_and_cast,
+                                         self.hpo_config.dataset_dtype)
+
+        # place a contiguous block of partitions on each worker explicitly,
+        # the fold subsets derived from a partition are computed in place,
+        # on the same worker
+        workers = list(self.client.scheduler_info()['workers'])
+        self.partition_workers = [
+            workers[i_partition * len(workers) // dataset.npartitions]
+            for i_partition in range(dataset.npartitions)
+        ]
+
+        # keep the ingested partitions resident in worker GPU memory so that
+        # subsequent CV folds re-use them instead of re-reading from storage
+        self.dataset_futures = [
+            self.client.compute(partition, workers=[worker])
+            for partition, worker in zip(dataset.to_delayed(),
+                                         self.partition_workers)
+        ]
+
+        # assign every sample to a CV fold once, folds are then selected
+        # with a mask instead of re-splitting the dataset
+        n_splits = max(self.hpo_config.cv_folds, MIN_CV_SPLITS)
+        self.cv_fold_id_futures = [
+            self.client.submit(_assign_cv_folds, partition, n_splits,
+                               i_partition, workers=[worker])
+            for i_partition, (partition, worker) in enumerate(
+                zip(self.dataset_futures, self.partition_workers)
             )
+        ]
+        wait(self.dataset_futures + self.cv_fold_id_futures)
 
-        hpo_log.info(f'\t dataset len: {len(dataset)}')
+        dataset = dask.dataframe.from_delayed(self.dataset_futures,
+                                              meta=dataset._meta)
+
+        hpo_log.info(f'\t dataset partitions: {dataset.npartitions}')
         self.dataset_cache = dataset
         return dataset
 
     def handle_missing_data(self, dataset):
-        """ Drop samples with missing data [ inplace ] """
-        dataset = dataset.dropna()
+        """ Missing samples are dropped during ingestion [ no-op ] """
         return dataset
 
     @timer_decorator
     def split_dataset(self, dataset, random_state):
         """
         Split dataset into train and test data subsets,
-        currently using CV-fold index for randomness.
-        Plan to refactor with dask_ml KFold
+        the CV-fold index [ random_state ] selects the held-out fold
         """
         hpo_log.info('> train-test split')
-        label_column = self.hpo_config.label_column
 
-        train, test = train_test_split(dataset, random_state=random_state)
+        X_train, y_train, X_test, y_test = self.persist_split(random_state)
 
-        # build X [ features ], y [ labels ] for the train and test subsets
-        y_train = train[label_column]
-        X_train = train.drop(label_column, axis=1)
-        y_test = test[label_column]
-        X_test = test.drop(label_column, axis=1)
+        # wait!
+        wait([X_train, y_train])
 
-        # force execution
-        X_train, y_train, X_test, y_test = persist_across_workers(
-            self.client,
-            [X_train, y_train, X_test, y_test],
-            workers=self.client.has_what().keys()
-        )
+        # training partitions are restricted to the worker holding their
+        # source partition, move them only if a worker was left without any
+        train_workers = self.workers_holding(X_train)
+        if len(train_workers) < self.n_workers:
+            self.client.rebalance(futures_of(X_train) + futures_of(y_train))
+            train_workers = self.workers_holding(X_train)
 
-        # wait!
-        wait([X_train, y_train, X_test, y_test])
+        # fail fast, distributed training hangs on workers without data
+        if len(train_workers) < self.n_workers:
+            raise Exception(f'! training data on {len(train_workers)}'
+                            f'/{self.n_workers} workers')
+
+        self.fold_futures = [
+            future for collection in (X_train, y_train, X_test, y_test)
+            for future in futures_of(collection)
+        ]
 
-        return (X_train.astype(self.hpo_config.dataset_dtype),
-                X_test.astype(self.hpo_config.dataset_dtype),
-                y_train.astype(self.hpo_config.dataset_dtype),
-                y_test.astype(self.hpo_config.dataset_dtype))
+        return X_train, X_test, y_train, y_test
+
+    def persist_split(self, i_fold):
+        """
+        Start persisting the train and test subsets of a fold,
+        computed in place on the workers [ async ]
+        """
+        label_column = self.hpo_config.label_column
+        features_meta = self.dataset_cache._meta.drop(columns=[label_column])
+        labels_meta = self.dataset_cache._meta[label_column]
+
+        # partition-local masks over the cached dataset, each training
+        # partition is built on the worker holding its source partition
+        cached_partitions = list(zip(self.dataset_futures,
+                                     self.cv_fold_id_futures,
+                                     self.partition_workers))
+
+        X_train = dask.dataframe.from_delayed([
+            self.client.submit(_fold_features, partition, cv_fold_ids,
+                               i_fold, label_column, False, workers=[worker])
+            for partition, cv_fold_ids, worker in cached_partitions
+        ], meta=features_meta)
+        y_train = dask.dataframe.from_delayed([
+            self.client.submit(_fold_labels, partition, cv_fold_ids,
+                               i_fold, label_column, False, workers=[worker])
+            for partition, cv_fold_ids, worker in cached_partitions
+        ], meta=labels_meta)
+
+        # gather the held-out samples of each worker's partitions into one
+        # test partition on that worker, so that inference runs as a single
+        # large batch per GPU and no data moves across workers; X_test and
+        # y_test are grouped the same way and stay aligned for scoring
+        worker_partitions = {}
+        for partition, cv_fold_ids, worker in cached_partitions:
+            partitions, fold_ids = worker_partitions.setdefault(worker,
+                                                                ([], []))
+            partitions.append(partition)
+            fold_ids.append(cv_fold_ids)
+
+        X_test = dask.dataframe.from_delayed([
+            self.client.submit(_concat_fold_subsets, _fold_features,
+                               partitions, fold_ids, i_fold, label_column,
+                               True, workers=[worker])
+            for worker, (partitions, fold_ids) in worker_partitions.items()
+        ], meta=features_meta)
+        y_test = dask.dataframe.from_delayed([
+            self.client.submit(_concat_fold_subsets, _fold_labels,
+                               partitions, fold_ids, i_fold, label_column,
+                               True, workers=[worker])
+            for worker, (partitions, fold_ids) in worker_partitions.items()
+        ], meta=labels_meta)
+
+        return X_train, y_train, X_test, y_test
+
+    def release_fold_data(self):
+        """ Release the persisted train and test subsets of this fold """
+        if self.fold_futures is not None:
+            self.client.cancel(self.fold_futures)
+            self.fold_futures = None
+
+    def workers_holding(self, collection):
+        """ Set of workers holding partitions of a persisted collection """
+        return set().union(
+            *self.client.who_has(futures_of(collection)).values()
+        )
 
     @timer_decorator
     def fit(self, X_train, y_train):
         """ Fit decision tree model """
-        if 'XGBoost' in self.hpo_config.model_type:
-            hpo_log.info('> fit xgboost model')
-            dtrain = xgboost.dask.DaskDMatrix(self.client, X_train, y_train)
-            num_boost_round = self.hpo_config.model_params['num_boost_round']
-
-            xgboost_output = xgboost.dask.train(
-                self.client,
-                self.hpo_config.model_params, dtrain,
-                num_boost_round=num_boost_round
-            )
+        return self._fit(X_train, y_train)
+
+    def _fit_xgboost(self, X_train, y_train):
+        hpo_log.info('> fit xgboost model')
+        # build the quantile sketch directly from the device data rather
+        # than copying it into an intermediate DMatrix; the cuDF columns
+        # are read in place through __cuda_array_interface__ so no
+        # Arrow or host staging of the partitions is needed
+        dtrain = xgboost.dask.DaskDeviceQuantileDMatrix(
+            self.client, X_train, y_train,
+            max_bin=self.hpo_config.model_params['max_bin']
+        )
+        num_boost_round = self.hpo_config.model_params['num_boost_round']
 
-            trained_model = xgboost_output['booster']
+        xgboost_output = xgboost.dask.train(
+            self.client,
+            self.hpo_config.model_params, dtrain,
+            num_boost_round=num_boost_round
+        )
 
-        elif 'RandomForest' in self.hpo_config.model_type:
-            hpo_log.info('> fit randomforest model')
-            trained_model = RandomForestClassifier(
-                n_estimators=self.hpo_config.model_params['n_estimators'],
-                max_depth=self.hpo_config.model_params['max_depth'],
-                max_features=self.hpo_config.model_params['max_features'],
-                n_bins=self.hpo_config.model_params['n_bins']
-            ).fit(X_train, y_train.astype('int32'))
+        return xgboost_output['booster']
 
-        return trained_model
+    def _fit_randomforest(self, X_train, y_train):
+        hpo_log.info('> fit randomforest model')
+        return RandomForestClassifier(
+            n_estimators=self.hpo_config.model_params['n_estimators'],
+            max_depth=self.hpo_config.model_params['max_depth'],
+            max_features=self.hpo_config.model_params['max_features'],
+            n_bins=self.hpo_config.model_params['n_bins']
+        ).fit(X_train, y_train.astype('int32'))
 
     @timer_decorator
     def predict(self, trained_model, X_test, threshold=0.5):
         """ Inference with the trained model on the unseen test data """
 
         hpo_log.info('> predict with trained model ')
-        if 'XGBoost' in self.hpo_config.model_type:
-            dtest = xgboost.dask.DaskDMatrix(self.client, X_test)
-            predictions = xgboost.dask.predict(
-                self.client,
-                trained_model,
-                dtest
-            ).compute()
+        return self._predict(trained_model, X_test, threshold)
 
-            predictions = (predictions > threshold) * 1.0
+    def _predict_xgboost(self, trained_model, X_test, threshold):
+        # predicting on the dataframe keeps the output partitioned like
+        # X_test [ and y_test ], predictions stay lazy on the workers
+        predictions = xgboost.dask.predict(
+            self.client,
+            trained_model,
+            X_test
+        )
 
-        elif 'RandomForest' in self.hpo_config.model_type:
-            predictions = trained_model.predict(X_test).compute()
+        # threshold on the device, in the label dtype [ not float64 ]
+        return (predictions > threshold).astype(self.hpo_config.dataset_dtype)
 
-        return predictions
+    def _predict_randomforest(self, trained_model, X_test, threshold):
+        return trained_model.predict(X_test)
 
     @timer_decorator
     def score(self, y_test, predictions):
         """ Score predictions vs ground truth labels on test data """
         hpo_log.info('> score predictions')
-        y_test = y_test.compute()
-        score = accuracy_score(
-            y_test.astype(self.hpo_config.dataset_dtype),
-            predictions.astype(self.hpo_config.dataset_dtype)
+
+        # count correct predictions on each worker, only scalars reach
+        # the client
+        partition_counts = [
+            dask.delayed(_count_correct)(y_partition, predictions_partition)
+            for y_partition, predictions_partition in zip(
+                y_test.to_delayed(), predictions.to_delayed()
+            )
+        ]
+        n_correct, n_samples = dask.compute(
+            dask.delayed(sum)(partition_counts), y_test.size
         )
+        score = n_correct / n_samples
 
         hpo_log.info(f'\t score = {score}')
         self.cv_fold_scores.append(score)
@@ -214,27 +465,35 @@ class MLWorkflowMultiGPU(MLWorkflow):
                 self.hpo_config.model_store_directory,
                 filename
             )
+            self._save_model(trained_model, output_filename)
+
+    def _save_xgboost(self, trained_model, output_filename):
+        trained_model.save_model(f'{output_filename}_mgpu_xgb')
 
-            if 'XGBoost' in self.hpo_config.model_type:
-                trained_model.save_model(f'{output_filename}_mgpu_xgb')
-            elif 'RandomForest' in self.hpo_config.model_type:
-                joblib.dump(trained_model, f'{output_filename}_mgpu_rf')
+    def _save_randomforest(self, trained_model, output_filename):
+        # gather the forest into a single-GPU model, which pickles
+        # as its serialized treelite bytes [ no distributed state ]
+        combined_model = trained_model.get_combined_model()
+        joblib.dump(combined_model, f'{output_filename}_mgpu_rf')
 
     @timer_decorator
-    async def cleanup( self, i_fold):
+    def cleanup(self, i_fold):
         """
-        Close and restart the cluster when multiple cross validation folds
-        are used to prevent memory creep.
+        Release per-fold memory on the workers between cross validation
+        folds, and close the cluster once all folds are complete.
+        The cluster is kept alive between folds to preserve CUDA contexts,
+        memory pools and the cached dataset.
         """
         if i_fold == self.hpo_config.cv_folds - 1:
             hpo_log.info('> done all folds; closing cluster')
-            await self.client.close()
-            await self.cluster.close()
+            self.client.close()
+            self.cluster.close()
         elif i_fold < self.hpo_config.cv_folds - 1:
-            hpo_log.info('> end of fold; reinitializing cluster')
-            await self.client.close()
-            await self.cluster.close()
-            self.cluster, self.client = self.cluster_initialize()
+            hpo_log.info('> end of fold; releasing worker memory')
+            # train.py still references this fold's collections, so their
+            # futures are released explicitly rather than when collected
+            self.release_fold_data()
+            self.client.run(gc.collect)
 
     def emit_final_score(self):
         """ Emit score for parsing by the cloud HPO orchestrator """
@@ -244,7 +503,8 @@ class MLWorkflowMultiGPU(MLWorkflow):
         if self.hpo_config.cv_folds > 1:
             hpo_log.info(f'fold scores : {self.cv_fold_scores}')
 
-        # average over CV folds
+        # average over CV folds [ host floats, already reduced on the
+        # workers, so no device synchronization happens here ]
         final_score = sum(self.cv_fold_scores) / len(self.cv_fold_scores)
 
         hpo_log.info(f'final-score: {final_score};')